@@ -2,8 +2,8 @@
 popularity.py
 
 This script implements functions to simulate popularity scenario simulations
-and append results to shared lists. It introduces missing data unbiased on state
-popularity, calculates RMSE, and appends results after each run.
+and collect the results in a DataFrame. It introduces missing data biased on state
+popularity, calculates KL divergence and inaccuracy, and records one row per run.
 
 Author: Ben Harwood
 Contact: bharwood@syr.edu
@@ -11,25 +11,25 @@ Website: https://github.com/bharwood-data/Markov-Chains
 
 Functions:
     introduce_popularity_bias: Introduces missing data unbiased on state popularity.
-    popAppend: Appends popularity scenario results to shared lists.
-    process_popularity: Runs popularity scenario simulations and appends results.
+    run_popularity: Runs a single popularity scenario simulation.
+    process_popularity: Runs popularity scenario simulations and returns the results.
 
 Dependencies:
     - pandas: A powerful data manipulation library.
     - numpy: A fundamental package for scientific computing with Python.
     - time: A module providing various time-related functions.
     - itertools: A module providing iterators for efficient looping.
-    - random: A module providing functions for generating random numbers.
+    - multiprocessing: A module providing process-based parallelism.
+    - os: A module providing operating system interfaces.
 
     - generate_standard_transition_matrix: Generates a standard transition matrix.
     - generate_initial_states: Generates initial states for multiple agents.
     - generate_markov_chains: Generates Markov chains for multiple agents.
     - extract_transition_matrix: Extracts a transition matrix from a DataFrame.
-    - kl_divergence: Calculates the Kullback-Leibler divergence.
+    - kl_divergence_batch: Calculates the Kullback-Leibler divergence for a stack of matrices.
     - generate_random_prevalence_ratios: Generates random prevalence ratios.
     - construct_weighted_transition_matrix: Constructs a weighted transition matrix.
     - generate_custom_initial_distribution: Generates a custom initial distribution.
-    - introduce_popularity_bias: Introduces popularity bias to data.
     - forward_algorithm: Performs forward algorithm for imputation.
     - em_algorithm: Performs EM algorithm for optimization.
 """
@@ -38,34 +38,43 @@ import pandas as pd
 import numpy as np
 import time as time
 import itertools
-import random
+import multiprocessing
+import os
 
 from bmcUtils import generate_standard_transition_matrix, generate_initial_states, generate_markov_chains, \
-    extract_transition_matrix, kl_divergence, kl_divergence, generate_random_prevalence_ratios, construct_weighted_transition_matrix, \
-    generate_custom_initial_distribution, introduce_popularity_bias
+    extract_transition_matrix, kl_divergence_batch, generate_random_prevalence_ratios, construct_weighted_transition_matrix, \
+    generate_custom_initial_distribution
 import bmcSpecial as bmc
 
-def introduce_popularity_bias(d1, state_probabilities, desired_missing_pct, N, T, asc):
+# Module-wide random generator used when callers do not supply their own
+_rng = np.random.default_rng()
+
+def introduce_popularity_bias(chains, ordered_states, desired_missing_pct, N, T, rng=None):
     """
     Introduces missing data biased on state popularity.
 
-    Processes data to introduce missing values biased on specified state probabilities.
-    More popular states will have fewer missing values.
+    Processes data to introduce missing values biased on the given state order.
+    States earlier in the order are marked missing first, so ordering states by
+    descending probability leaves the less popular states with fewer missing values.
 
     Args:
-        d1 (DataFrame): Original data.
-        state_probabilities (DataFrame): DataFrame of state probabilities.
+        chains (np.ndarray): Original data as a 2D array of integer state codes.
+        ordered_states (np.ndarray): States in the order they should be marked missing.
         desired_missing_pct (float): Desired percentage of missing values.
         N (int): Number of rows in data.
         T (int): Number of columns in data.
-        asc (bool): Whether to sort states by probability in ascending order.
+        rng (np.random.Generator, optional): Random generator used to select missing values. Defaults to the module generator.
 
     Returns:
-        DataFrame: Data with missing values introduced.
+        np.ndarray: Float array of the observations after the first column, with missing values introduced as NaN.
     """
-    # Check if d1 and state_probabilities are DataFrames
-    if not isinstance(d1, pd.DataFrame) or not isinstance(state_probabilities, pd.DataFrame):
-        raise ValueError("d1 and state_probabilities must be pandas DataFrames")
+    # Check if chains is a 2D NumPy array
+    if not isinstance(chains, np.ndarray) or chains.ndim != 2:
+        raise ValueError("chains must be a 2D numpy array")
+
+    # Check if ordered_states is a NumPy array
+    if not isinstance(ordered_states, np.ndarray):
+        raise ValueError("ordered_states must be a numpy array")
 
     # Check if N and T are integers
     if not isinstance(N, int) or not isinstance(T, int):
@@ -75,129 +84,112 @@ def introduce_popularity_bias(d1, state_probabilities, desired_missing_pct, N, T
     if not isinstance(desired_missing_pct, float) or not 0 <= desired_missing_pct <= 1:
         raise ValueError("desired_missing_pct must be a float between 0 and 1")
 
-    # Check if asc is a boolean
-    if not isinstance(asc, bool):
-        raise ValueError("asc must be a boolean")
+    # Check if rng is a NumPy random generator
+    if rng is not None and not isinstance(rng, np.random.Generator):
+        raise ValueError("rng must be a numpy Generator or None")
 
     try:
-        # Create a copy of the original data
-        d2 = d1.iloc[:, 1:].copy()
-        states = state_probabilities.shape[0]
-        
-        # Sort the states by probability
-        sorted_states = state_probabilities.sort_values(by='Probability', ascending=asc)
+        # Resolve the random generator and select the observation columns
+        rng = _rng if rng is None else rng
+        codes = chains[:, 1:]
+        states = ordered_states.size
 
         # Calculate the desired number of missing values
         desired_missing_count = round(desired_missing_pct * N * T)
 
-        # Create a list to store state indices
-        state_indices_list = [[] for _ in range(states)]
-
-        # Store the indices of each state's observations
-        for state in range(states):
-            state_indices_list[state] = np.where(d1.values == state)
-
         # Initialize a variable to track the remaining missing count
         remaining_missing_count = desired_missing_count
 
+        # Copy the data once into a C-ordered float32 array so the flat view writes through
+        arr = np.array(codes, dtype=np.float32, order='C')
+        flat = arr.reshape(-1)
+
+        # Bucket the flat indices of each state's observations in a single pass over the compact integer codes
+        codes = codes.ravel()
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(states + 1))
+        buckets = [order[bounds[state]:bounds[state + 1]] for state in range(states)]
+
         # Loop through the states in order of probability
-        for i in range(len(sorted_states)):
+        for state in ordered_states:
             if remaining_missing_count <= 0:
                 break
-            state = sorted_states['State'].values[i]
-            
-            occurrences = (d2 == state).sum().sum()
+            idx = buckets[state]
             
             # Calculate the number of occurrences to mark as NaN
-            needed = int(occurrences * 0.9)
+            needed = min(int(0.9 * len(idx)), remaining_missing_count)
             
-            # Randomly generate observations for the current state
+            # Randomly select observations for the current state and mark them as NaN
             if needed > 0:
-                # Identify the indices of occurrences for the current state
-                state_indices = np.where(d2.values == state)
-                
-                # Randomly select indices for the current state
-                selected_indices = random.sample(list(zip(state_indices[0], state_indices[1])), k=needed)
+                if needed > idx.size // 2:
+                    # Sample the smaller set of observations to keep and mark the rest
+                    mark = np.ones(idx.size, dtype=bool)
+                    mark[rng.choice(idx.size, size=idx.size - needed, replace=False)] = False
+                    chosen = idx[mark]
+                else:
+                    chosen = idx[rng.choice(idx.size, size=needed, replace=False)]
+                flat[chosen] = np.nan
                 
-                # Mark occurrences as NaN using the selected indices
-                for index in selected_indices:
-                    d2.iloc[index] = np.nan
-                    # Update the remaining missing count
-                    remaining_missing_count -= 1
-                    if remaining_missing_count == 0:
-                        break
-
-        return d2
+                # Update the remaining missing count
+                remaining_missing_count -= needed
+
+        return arr
     except Exception as e:
         raise ValueError(f"An error occurred during popularity bias introduction: {e}")
     
-def popAppend(states_list, states, missing_list, pct, time_list, standard_time, KL_list, KL, inaccuracy_list, inaccuracy, agents_list, N, obs_list, 
-              T, popularity_list, popularity, imputed_list=None, imputed=None, em_list=None, em=None, emTime_list=None, emTime=None, 
-              imputed_time_list=None, imputedTime=None):
+def run_popularity(chains, ordered_states, pct, N, T, states, imputation=False, optimization=False, em_iterations=None, tol=None,
+                   rng=None):
     """
-    Appends population scenario results to respective lists.
+    Runs a single popularity scenario simulation.
 
-    This function appends various simulation results to their respective lists, including states, missing percentage, execution time, KL divergence,
-    inaccuracy, number of agents, number of observations, and popularity.
+    Introduces popularity bias at the given missing percentage, estimates the transition matrix, and optionally performs
+    imputation and optimization. Runs are independent of one another, so process_popularity can dispatch them to worker processes.
 
     Args:
-        states_list (list): List to append the number of states to.
-        states (int): Number of states.
-        missing_list (list): List to append the missing percentage to.
+        chains (np.ndarray): Generated Markov chains for all agents as integer state codes.
+        ordered_states (np.ndarray): States in the order they should be marked missing.
         pct (float): Missing percentage.
-        time_list (list): List to append the execution time to.
-        standard_time (float): Execution time.
-        KL_list (list): List to append the KL divergence to.
-        KL (float): KL divergence.
-        inaccuracy_list (list): List to append the inaccuracy to.
-        inaccuracy (float): Inaccuracy.
-        agents_list (list): List to append the number of agents to.
         N (int): Number of agents.
-        obs_list (list): List to append the number of observations to.
         T (int): Number of observations.
-        popularity_list (list): List to append the popularity to.
-        popularity (float): Popularity.
-        imputed_list (list, optional): List to append the imputation result to. Defaults to None.
-        imputed: Imputation result. Defaults to None.
-        em_list (list, optional): List to append the EM result to. Defaults to None.
-        em: EM result. Defaults to None.
-        emTime_list (list, optional): List to append the EM execution time to. Defaults to None.
-        emTime (float, optional): EM execution time. Defaults to None.
-        imputed_time_list (list, optional): List to append the imputation execution time to. Defaults to None.
-        imputedTime (float, optional): Imputation execution time. Defaults to None.
+        states (int): Number of states.
+        imputation (bool, optional): Flag indicating whether to perform imputation. Defaults to False.
+        optimization (bool, optional): Flag indicating whether to perform optimization. Defaults to False.
+        em_iterations (int, optional): Number of EM algorithm iterations. Defaults to None.
+        tol (float, optional): Tolerance for convergence in optimization. Defaults to None.
+        rng (np.random.Generator, optional): Random generator used to select missing values. Defaults to the module generator.
+            The EM algorithm still draws from the global np.random state.
 
     Returns:
-        tuple: Tuple containing updated lists of simulation results.
+        dict: Estimated, imputed and EM transition matrices along with their execution times. Entries for skipped steps are None.
     """
+    # Introduce popularity bias to the Markov chain
+    biased = introduce_popularity_bias(chains, ordered_states, pct, N, T, rng)
+    has_missing = np.isnan(biased).any()
+    result = pd.DataFrame(biased, columns=np.arange(1, chains.shape[1]))
+    start = time.time()  # Start time of execution
+    estimated = extract_transition_matrix(result, states)  # Estimate transition matrix
+    end = time.time()  # End time of execution
     
-    # Append states, missing %, execution time, KL divergence, inaccuracy, number of agents, number of observations, and popularity to respective lists
-    states_list.append(states)
-    missing_list.append(pct)
-    time_list.append(standard_time)
-    KL_list.append(KL)
-    inaccuracy_list.append(inaccuracy)
-    popularity_list.append(popularity)
-    agents_list.append(N)
-    obs_list.append(T)
+    # Perform imputation if requested, reusing the estimate when there is nothing to impute
+    final = bmc.forward_algorithm(result, estimated, T, states) if imputation and has_missing else None
+    estimated_imputed = (extract_transition_matrix(final, states) if has_missing else estimated) if imputation else None
+    end_impute = time.time() if imputation else None
     
-    # Append imputation result if available
-    if imputed_list is not None:
-        imputed_list.append(imputed)
-    # Append EM result if available
-    if em_list is not None:
-        em_list.append(em)
-    # Append EM execution time if available
-    if emTime_list is not None:
-        emTime_list.append(emTime)
-    # Append imputation execution time if available
-    if imputed_time_list is not None:
-        imputed_time_list.append(imputedTime)
-    
-    return states_list, missing_list, time_list, KL_list, \
-       inaccuracy_list, agents_list, obs_list, popularity_list, \
-       imputed_list, em_list, emTime_list, imputed_time_list
+    # Perform optimization if requested
+    estimated_em = bmc.em_algorithm(result, N, T, states, em_iterations, tol) if optimization else None
+    end_em = time.time() if optimization else None
+
+    return {
+        'estimated': estimated,
+        'estimated_imputed': estimated_imputed,
+        'estimated_em': estimated_em,
+        'time': end - start,
+        'imputed_time': end_impute - start if imputation else None,
+        'em_time': end_em - start if optimization else None,
+    }
 
-def process_popularity(states, N, T, missing_range, imputation=False, optimization=False, em_iterations=None, tol=None):
+def process_popularity(states, N, T, missing_range, imputation=False, optimization=False, em_iterations=None, tol=None, n_jobs=1,
+                       rng=None):
     """
     Process popularity scenario.
 
@@ -213,10 +205,17 @@ def process_popularity(states, N, T, missing_range, imputation=False, optimizati
         optimization (bool, optional): Flag indicating whether to perform optimization. Defaults to False.
         em_iterations (int, optional): Number of EM algorithm iterations. Defaults to None.
         tol (float, optional): Tolerance for convergence in optimization. Defaults to None.
+        n_jobs (int, optional): Number of worker processes. Defaults to 1, which runs serially; None uses all available CPUs.
+            Runs then compete for cores and memory bandwidth, so execution times from parallel runs are not comparable with
+            serial ones or with the other scenario modules. Under the spawn start method, callers must guard the call with
+            if __name__ == "__main__".
+        rng (np.random.Generator, optional): Random generator from which each run's missing-value generator is spawned. Defaults to the
+            module generator. It only covers missing-value selection: chain generation and the EM algorithm draw from the global
+            np.random state, so seeding rng alone does not make results reproducible, and EM results may depend on n_jobs.
 
     Returns:
-        tuple: Tuple containing lists of simulation results including states, missing data percentages, execution times, KL divergences, inaccuracy,
-               number of agents, number of observations, popularity, imputed results, EM results, and times for imputation and EM steps.
+        DataFrame: One row per simulation run with columns for states, missing data percentage, execution time, KL divergence, inaccuracy,
+                   number of agents, number of observations, and popularity, plus imputed and EM results and times when requested.
     """
     
     try:
@@ -237,20 +236,10 @@ def process_popularity(states, N, T, missing_range, imputation=False, optimizati
             raise ValueError("em_iterations must be a positive integer or None")
         if tol is not None and (not isinstance(tol, float) or tol < 0):
             raise ValueError("tol must be a non-negative float or None")
-        # Initialize shared lists to store results
-        states_list = []
-        missing_list = []
-        emTime_list = []
-        KL_list = []
-        inaccuracy_list = []
-        popularity_list = []
-        agents_list = []
-        obs_list = []
-        imputed_list = []
-        em_list = []
-        time_list = []
-        imputed_time_list = []
-        
+        if n_jobs is not None and (not isinstance(n_jobs, int) or n_jobs <= 0):
+            raise ValueError("n_jobs must be a positive integer or None")
+        if rng is not None and not isinstance(rng, np.random.Generator):
+            raise ValueError("rng must be a numpy Generator or None")
         # Generate observed transition matrix
         observed = generate_standard_transition_matrix(states)
         # Generate random prevalence ratios
@@ -263,43 +252,77 @@ def process_popularity(states, N, T, missing_range, imputation=False, optimizati
         initial_states = generate_initial_states(weighted_transition_matrix, N, initial_distribution)
         # Generate Markov chains for multiple agents
         markov_chain = generate_markov_chains(weighted_transition_matrix, initial_states, T, N)
+        # Convert the chains once to the smallest integer type that holds every state
+        chains = markov_chain.to_numpy(dtype=np.min_scalar_type(states - 1))
 
         # Calculate state probabilities
-        probs = np.array([np.sum(markov_chain.values == state) / markov_chain.values.size for state in range(states)])
+        counts = np.bincount(chains.ravel(), minlength=states)
+        probs = counts / counts.sum()
         state_probabilities = pd.DataFrame({'State': np.arange(0, states), 'Probability': probs})
+
+        # Order the states by probability once for both popularity directions
+        order_asc = state_probabilities.sort_values('Probability', ascending=True)['State'].to_numpy()
+        order_desc = state_probabilities.sort_values('Probability', ascending=False)['State'].to_numpy()
+
+        # Normalizing constant for the inaccuracy metric, invariant across iterations
+        denom = np.sqrt(2*states) * np.linalg.norm(observed)
         
-        # Iterate over different popularity orders and missing data percentages
-        for popularity, pct in list(itertools.product([True, False], missing_range)):
-                # Introduce popularity bias to the Markov chain
-                result = pd.DataFrame(introduce_popularity_bias(markov_chain, state_probabilities, pct, N, T, popularity))
-                start = time.time()  # Start time of execution
-                estimated = extract_transition_matrix(result, states)  # Estimate transition matrix
-                end = time.time()  # End time of execution
-                
-                # Perform imputation if requested
-                final = bmc.forward_algorithm(result, estimated, T, states) if imputation else None
-                estimated_imputed = extract_transition_matrix(final, states) if imputation else None
-                end_impute = time.time() if imputation else None
-                
-                # Perform optimization if requested
-                estimated_em = bmc.em_algorithm(result, N, T, states, em_iterations, tol) if optimization else None
-                end_em = time.time() if optimization else None
-                
-                # Append results to shared lists using popAppend function
-                states_list, missing_list, emTime_list, KL_list, inaccuracy_list, agents_list, obs_list, popularity_list, imputed_list, \
-                    em_list, time_list, imputed_time_list = popAppend(
-                        states_list, states, missing_list, pct, time_list, end - start, KL_list,
-                        kl_divergence(estimated, observed, states), inaccuracy_list,
-                        np.linalg.norm(estimated - observed)/(np.sqrt(2*states)*np.linalg.norm(observed)), agents_list, N, obs_list, T, 
-                        popularity_list, popularity, imputed_list if imputation else None,
-                        np.linalg.norm(estimated_imputed - observed)/(np.sqrt(2*states)*np.linalg.norm(observed)) if imputation else None,
-                        em_list if optimization else None,
-                        np.linalg.norm(estimated_em - observed)/(np.sqrt(2*states)*np.linalg.norm(observed)) if optimization else None,
-                        emTime_list, end_em - start if optimization else None, imputed_time_list, end_impute - start if imputation else None)
+        # Preallocate result columns, one row per (popularity, pct) pair
+        grid = list(itertools.product((True, False), missing_range))
+        n_iters = len(grid)
+        results = {
+            'states': np.full(n_iters, states),
+            'missing': np.array([pct for _, pct in grid]),
+            'time': np.empty(n_iters),
+            'agents': np.full(n_iters, N),
+            'obs': np.full(n_iters, T),
+            'popularity': np.array([popularity for popularity, _ in grid]),
+        }
+        columns = ['states', 'missing', 'time', 'KL', 'inaccuracy', 'agents', 'obs', 'popularity']
+        if imputation:
+            results['imputed_time'] = np.empty(n_iters)
+            columns += ['imputed', 'imputed_time']
+        if optimization:
+            results['em_time'] = np.empty(n_iters)
+            columns += ['em', 'em_time']
+
+        # Stacks of estimated transition matrices, scored together after the runs
+        est_all = np.empty((n_iters, states, states))
+        est_imputed_all = np.empty((n_iters if imputation else 0, states, states))
+        est_em_all = np.empty((n_iters if optimization else 0, states, states))
+        
+        # Run each popularity order and missing data percentage, in parallel unless a single job is requested.
+        # Each run gets its own spawned generator for missing-value selection so worker streams do not collide.
+        run_rngs = (_rng if rng is None else rng).spawn(n_iters)
+        tasks = [(chains, order_asc if popularity else order_desc, pct, N, T, states, imputation, optimization, em_iterations, tol, run_rng)
+                 for (popularity, pct), run_rng in zip(grid, run_rngs)]
+        n_jobs = min(n_jobs or os.cpu_count() or 1, n_iters)
+        if n_jobs == 1:
+            runs = list(itertools.starmap(run_popularity, tasks))
+        else:
+            with multiprocessing.Pool(n_jobs) as pool:
+                runs = pool.starmap(run_popularity, tasks)
+        
+        # Collect the estimates and execution times of each run
+        for i, run in enumerate(runs):
+            est_all[i] = run['estimated']
+            results['time'][i] = run['time']
+            if imputation:
+                est_imputed_all[i] = run['estimated_imputed']
+                results['imputed_time'][i] = run['imputed_time']
+            if optimization:
+                est_em_all[i] = run['estimated_em']
+                results['em_time'][i] = run['em_time']
+
+        # Score all estimates against the observed matrix at once
+        results['KL'] = kl_divergence_batch(est_all, observed, states)
+        results['inaccuracy'] = np.linalg.norm(est_all - observed, axis=(1, 2))/denom
+        if imputation:
+            results['imputed'] = np.linalg.norm(est_imputed_all - observed, axis=(1, 2))/denom
+        if optimization:
+            results['em'] = np.linalg.norm(est_em_all - observed, axis=(1, 2))/denom
         
-        # Return tuple of updated shared lists
-        return states_list, missing_list, emTime_list, KL_list, inaccuracy_list, agents_list, obs_list, popularity_list, \
-            imputed_list, em_list, time_list, imputed_time_list
+        return pd.DataFrame(results, columns=columns)
     
     except Exception as e:
         raise ValueError(f"Error in processing outlier scenario: {e}")
@@ -11,6 +11,7 @@ Website: https://github.com/bharwood-data/Markov-Chains
 
 Functions:
 - kl_divergence(): Calculates the Kullback-Leibler divergence between two probability distributions.
+- kl_divergence_batch(): Calculates the Kullback-Leibler divergence for a stack of estimated transition matrices.
 - is_valid_transition_matrix(): Checks if a matrix is a valid transition matrix.
 - calculate_steady_state(): Calculates the steady-state distribution of a Markov chain.
 - state_counts(): Calculates expected state counts and frequencies from chains data.
@@ -28,6 +29,7 @@ import pandas as pd
 import numpy as np
 import itertools
 from scipy.stats import entropy
+from scipy.special import rel_entr
 
 def kl_divergence(estimated, observed, states):
     """
@@ -66,6 +68,46 @@ def kl_divergence(estimated, observed, states):
         kl_divergences[i] = entropy(observed[i], estimated[i])
     return sum(kl_divergences)
 
+def kl_divergence_batch(estimated, observed, states):
+    """
+    Calculates the Kullback-Leibler divergence for a stack of estimated transition matrices.
+
+    Vectorized equivalent of calling kl_divergence() on each matrix in the stack.
+
+    Args:
+        estimated (numpy.ndarray): Stack of estimated transition matrices with shape (n, states, states).
+        observed (numpy.ndarray): The observed transition matrix with shape (states, states).
+        states (int): The number of states in the distributions.
+
+    Returns:
+        numpy.ndarray: The Kullback-Leibler divergence of each estimated matrix from the observed matrix.
+
+    Raises:
+        ValueError: If the shapes of estimated or observed do not match states.
+        TypeError: If estimated or observed are not NumPy arrays or if states is not an integer.
+    """
+    # Check if estimated and observed are NumPy arrays
+    if not isinstance(estimated, np.ndarray) or not isinstance(observed, np.ndarray):
+        raise TypeError("estimated and observed must be NumPy arrays")
+
+    # Check if states is an integer
+    if not isinstance(states, int):
+        raise TypeError("states must be an integer")
+
+    # Check if estimated and observed have the expected shapes
+    if estimated.ndim != 3 or estimated.shape[1:] != (states, states) or observed.shape != (states, states):
+        raise ValueError("estimated must have shape (n, states, states) and observed must have shape (states, states)")
+
+    # Shift any matrix containing zeros, as kl_divergence() does
+    if 0 in observed:
+        observed = observed + 0.0000000001
+    estimated = estimated + 0.0000000001 * (estimated == 0).any(axis=(1, 2))[:, None, None]
+
+    # Normalize each row and sum the row-wise divergences
+    p = observed / observed.sum(axis=1, keepdims=True)
+    q = estimated / estimated.sum(axis=2, keepdims=True)
+    return rel_entr(p, q).sum(axis=(1, 2))
+
 def is_valid_transition_matrix(transition_matrix):
     """
     Check if the given matrix is a valid transition matrix.